@@ -1,15 +1,18 @@
 import argparse
-import json
-import csv
-import time
+import asyncio
 import os
 from tqdm import tqdm
 
+from utils import (RETRYABLE_ERRORS, WRITE_BATCH_SIZE, get_prompt, iter_json_items, open_output_csv, retry_delay,
+                   sync_to_disk)
+
 # Optional imports for API libraries
 try:
-    from openai import OpenAI
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 except ImportError:
-    OpenAI = None
+    AsyncOpenAI = None
+    DefaultAsyncHttpxClient = None
 
 try:
     import google.generativeai as genai
@@ -17,35 +20,54 @@ except ImportError:
     genai = None
 
 
-def get_api_responses(model_name, api_key, base_url, json_path, custom_string, output_csv, method):
+# List of model name prefixes that are compatible with the OpenAI client
+OPENAI_COMPATIBLE_PREFIXES = ['gpt', 'deepseek']
+
+
+def get_model_type(model_name):
+    """Returns 'openai' or 'gemini' depending on which client serves the model, or None if unsupported."""
+    if any(prefix in model_name.lower() for prefix in OPENAI_COMPATIBLE_PREFIXES):
+        return 'openai'
+    if 'gemini' in model_name.lower():
+        return 'gemini'
+    return None
+
+
+def create_http_client():
     """
-    Processes JSON data, gets responses from an API-based model, and saves them to a CSV file.
+    Creates a pooled HTTP client that can be shared by every OpenAI-compatible client in a run,
+    so keep-alive connections are reused instead of re-doing the TCP/TLS handshake.
+    Returns None if the 'openai' library is not installed.
+    """
+    if not DefaultAsyncHttpxClient:
+        return None
+    return DefaultAsyncHttpxClient(limits=httpx.Limits(max_keepalive_connections=32, max_connections=64))
+
+
+def create_api_client(model_name, api_key, base_url, http_client=None):
+    """
+    Configures the correct API client based on the model name and base_url.
 
     Args:
     model_name (str): The name of the API model (e.g., 'gpt-4o', 'deepseek-chat').
     api_key (str): The API key for the service.
     base_url (str, optional): The base URL for the API endpoint.
-    json_path (str): Path to the input JSON file.
-    custom_string (str): A custom string to prepend to the prompt.
-    output_csv (str): Path for the output CSV file.
-    method (str): The method to determine which prompt format to use ('nja' or 'None').
-    """
-    # 1. Configure the correct API client based on the model name and base_url
-    client = None
-    model_type = None
+    http_client (httpx.AsyncClient, optional): A shared HTTP client for OpenAI-compatible models.
 
-    # List of model name prefixes that are compatible with the OpenAI client
-    openai_compatible_prefixes = ['gpt', 'deepseek']
+    Returns:
+    The configured client, or None if the model name is not supported.
+    """
+    model_type = get_model_type(model_name)
 
-    if any(prefix in model_name.lower() for prefix in openai_compatible_prefixes):
-        if not OpenAI:
+    if model_type == 'openai':
+        if not AsyncOpenAI:
             raise ImportError("The 'openai' library is required. Please install it with 'pip install openai'.")
         print(f"Configuring client for OpenAI-compatible model: {model_name}")
         print(f"Using API Base URL: {base_url}")
-        client = OpenAI(api_key=api_key, base_url=base_url)
-        model_type = 'openai'
+        # The SDK's own retries are off so that get_api_responses' retry loop is the only retry policy
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
 
-    elif 'gemini' in model_name.lower():
+    if model_type == 'gemini':
         if not genai:
             raise ImportError(
                 "The 'google-generativeai' library is required. Please install it with 'pip install google-generativeai'.")
@@ -54,79 +76,142 @@ def get_api_responses(model_name, api_key, base_url, json_path, custom_string, o
         # Gemini uses client_options to set the endpoint
         client_options = {"api_endpoint": base_url} if base_url else None
         genai.configure(api_key=api_key, client_options=client_options)
-        client = genai.GenerativeModel(model_name=model_name)
-        model_type = 'gemini'
+        return genai.GenerativeModel(model_name=model_name)
+
+    print(f"Error: Unsupported model name '{model_name}'. Cannot determine API type.")
+    return None
+
+
+async def get_api_responses(model_name, api_key, base_url, json_path, custom_string, output_csv, method,
+                            concurrency=8, client=None, max_retries=2, resume=True, fsync=False):
+    """
+    Processes JSON data, gets responses from an API-based model, and saves them to a CSV file.
 
-    else:
-        print(f"Error: Unsupported model name '{model_name}'. Cannot determine API type.")
+    Args:
+    model_name (str): The name of the API model (e.g., 'gpt-4o', 'deepseek-chat').
+    api_key (str): The API key for the service.
+    base_url (str, optional): The base URL for the API endpoint.
+    json_path (str): Path to the input JSON file.
+    custom_string (str): A custom string to prepend to the prompt.
+    output_csv (str): Path for the output CSV file.
+    method (str): The method to determine which prompt format to use ('nja' or 'None').
+    concurrency (int): Maximum number of API requests in flight at the same time.
+    client (optional): A client from create_api_client to reuse; one is created if not given.
+    max_retries (int): Number of retries after the first failed attempt before an item is recorded as an error.
+    resume (bool): Keep the successful rows of an existing output CSV and only process the rest.
+    fsync (bool): Flush the output CSV to disk with fsync once all rows are written.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be 1 or greater.")
+    if max_retries < 0:
+        raise ValueError("max_retries must be 0 or greater.")
+
+    # 1. Configure the API client, unless the caller already holds one
+    model_type = get_model_type(model_name)
+    if client is None:
+        client = create_api_client(model_name, api_key, base_url)
+    if client is None:
         return
 
-    # 2. Read the JSON data
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    # 2. Define the per-item request; the caller acquires the semaphore, which caps concurrent requests
+    semaphore = asyncio.Semaphore(concurrency)
 
-    total_items = len(data)
-    print(f"Processing started, found {total_items} records in {json_path}")
+    async def process(idx, input_text):
+        response_text = ""
+        status = "success"
 
-    # 3. Prepare the CSV file for writing
-    with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['id', 'input_text', 'response', 'response_length', 'status']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+        try:
+            # Retry logic for API calls
+            for attempt in range(max_retries + 1):
+                try:
+                    if model_type == 'openai':
+                        chat_completion = await client.chat.completions.create(
+                            model=model_name,
+                            messages=[{"role": "user", "content": input_text}],
+                            timeout=300
+                        )
+                        response_text = chat_completion.choices[0].message.content
 
-        # 4. Process each item with a tqdm progress bar
-        for idx, item in enumerate(tqdm(data, desc=f"Generating Responses ({model_name})", unit="item")):
-            prompt = item.get('nja_format', '') if method == 'nja' else item.get('prompt', '')
-            if not prompt:
+                    elif model_type == 'gemini':
+                        response = await client.generate_content_async(
+                            input_text,
+                            request_options={"timeout": 300}
+                        )
+                        response_text = response.text
+
+                    break  # Success, exit retry loop
+                except RETRYABLE_ERRORS as e:
+                    if attempt < max_retries:
+                        wait_time = retry_delay(attempt, e)
+                        print(
+                            f"\nAttempt {attempt + 1}/{max_retries + 1} failed for item {idx + 1}. "
+                            f"Retrying in {wait_time:.1f}s... Error: {e}")
+                        await asyncio.sleep(wait_time)
+                    else:
+                        raise
+
+        except Exception as e:
+            status = f"error: {type(e).__name__}"
+            response_text = f"ERROR: {str(e)}"
+            print(f"\nFailed to process item {idx + 1}: {e}")
+        finally:
+            semaphore.release()
+
+        return idx + 1, input_text, response_text, len(response_text), status
+
+    # The prompt template is the same for every item, so build its fixed parts once
+    prefix = f"User: {custom_string} "
+    suffix = "\nAssistant:"
+
+    def iter_inputs():
+        # Yields (idx, input_text) for every item with a usable prompt
+        for idx, item in enumerate(iter_json_items(json_path)):
+            prompt = get_prompt(item, method)
+            if prompt:
+                yield idx, prefix + prompt + suffix
+
+    # 3. Prepare the CSV file for writing. A previous run's rows only count as done if they were
+    #    generated from the same input text, which takes one extra pass over the JSON file.
+    print(f"Processing started, streaming records from {json_path}")
+    fieldnames = ['id', 'input_text', 'response', 'response_length', 'status']
+    expected_rows = None
+    if resume and os.path.exists(output_csv):
+        expected_rows = {idx + 1: {'input_text': input_text} for idx, input_text in iter_inputs()}
+    csvfile, writer, done_ids = open_output_csv(
+        output_csv, fieldnames, lambda row: row.get('status') == 'success', expected_rows=expected_rows,
+        resume=resume)
+    with csvfile:
+
+        rows = []
+        pbar = tqdm(desc=f"Generating Responses ({model_name})", unit="item")
+
+        def collect_row(task):
+            # Rows arrive as their requests finish (possibly out of id order) and are written in batches
+            rows.append(task.result())
+            pbar.update(1)
+            if len(rows) >= WRITE_BATCH_SIZE:
+                writer.writerows(rows)
+                rows.clear()
+
+        # 4. Stream the JSON records; parsing pauses whenever `concurrency` requests are in flight,
+        #    so parsing, requests and writing overlap
+        tasks = set()
+        for idx, input_text in iter_inputs():
+            if idx + 1 in done_ids:
                 continue
 
-            input_text = f"User: {custom_string} {prompt}\nAssistant:"
-            response_text = ""
-            status = "success"
-
-            try:
-                # Retry logic for API calls
-                for attempt in range(3):
-                    try:
-                        if model_type == 'openai':
-                            chat_completion = client.chat.completions.create(
-                                model=model_name,
-                                messages=[{"role": "user", "content": input_text}],
-                                timeout=300
-                            )
-                            response_text = chat_completion.choices[0].message.content
-
-                        elif model_type == 'gemini':
-                            response = client.generate_content(
-                                input_text,
-                                request_options={"timeout": 300}
-                            )
-                            response_text = response.text
-
-                        break  # Success, exit retry loop
-                    except Exception as e:
-                        if attempt < 2:
-                            wait_time = (attempt + 1) * 5
-                            print(
-                                f"\nAttempt {attempt + 1}/3 failed for item {idx + 1}. Retrying in {wait_time}s... Error: {e}")
-                            time.sleep(wait_time)
-                        else:
-                            raise
-
-            except Exception as e:
-                status = f"error: {type(e).__name__}"
-                response_text = f"ERROR: {str(e)}"
-                print(f"\nFailed to process item {idx + 1} after all retries: {e}")
-
-            writer.writerow({
-                'id': idx + 1,
-                'input_text': input_text,
-                'response': response_text,
-                'response_length': len(response_text),
-                'status': status
-            })
-
-            time.sleep(1)
+            await semaphore.acquire()
+            task = asyncio.create_task(process(idx, input_text))
+            task.add_done_callback(collect_row)
+            task.add_done_callback(tasks.discard)
+            tasks.add(task)
+
+        # 5. Wait for the remaining requests, then write the last partial batch
+        await asyncio.gather(*tasks)
+        writer.writerows(rows)
+        pbar.close()
+        if fsync:
+            sync_to_disk(csvfile)
 
 
 if __name__ == "__main__":
@@ -141,16 +226,32 @@ if __name__ == "__main__":
     parser.add_argument("--output_csv", type=str, required=True, help="Path for the output CSV file.")
     parser.add_argument("--method", type=str, required=True,
                         help="The processing method to use (e.g., 'nja' or 'None').")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Maximum number of API requests in flight at the same time.")
+    parser.add_argument("--max_retries", type=int, default=2,
+                        help="Retries after the first failed attempt before an item is recorded as an error.")
+    parser.add_argument("--no_resume", action="store_true",
+                        help="Start over instead of keeping the successful rows of an existing output CSV.")
+    parser.add_argument("--fsync", action="store_true",
+                        help="Flush the output CSV to disk with fsync once all rows are written.")
 
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be 1 or greater.")
+    if args.max_retries < 0:
+        parser.error("--max_retries must be 0 or greater.")
 
     # Pass the new base_url argument to the main function
-    get_api_responses(
+    asyncio.run(get_api_responses(
         args.model_name,
         args.api_key,
         args.base_url,
         args.json_path,
         args.custom_string,
         args.output_csv,
-        args.method
-    )
\ No newline at end of file
+        args.method,
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        resume=not args.no_resume,
+        fsync=args.fsync
+    ))
\ No newline at end of file
@@ -1,17 +1,26 @@
 import argparse
+import asyncio
 import csv
-import json
-import time
 from tqdm import tqdm
 
+from utils import RETRYABLE_ERRORS, WRITE_BATCH_SIZE, open_output_csv, retry_delay, sync_to_disk
+
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
+    from pydantic import BaseModel
 except ImportError:
     print("The 'openai' library is required for this script. Please install it with 'pip install openai'.")
     exit(1)
 
 
-def evaluate_responses(input_csv, prompt_file, output_csv, api_key, base_url):
+class EvalSchema(BaseModel):
+    """The structured verdict the evaluator model must return."""
+    score: int
+    reasoning: str
+
+
+async def evaluate_responses(input_csv, prompt_file, output_csv, api_key, base_url, concurrency=8, max_retries=2,
+                             resume=True, fsync=False):
     """
     Evaluates model responses in a CSV file using GPT-4o and saves the results.
 
@@ -21,13 +30,23 @@ def evaluate_responses(input_csv, prompt_file, output_csv, api_key, base_url):
     output_csv (str): Path for the output CSV file with evaluation results.
     api_key (str): Your OpenAI API key.
     base_url (str, optional): The base URL for the OpenAI API endpoint.
+    concurrency (int): Maximum number of evaluation requests in flight at the same time.
+    max_retries (int): Number of retries after the first failed attempt before a row is recorded as an error.
+    resume (bool): Keep the finished rows of an existing output CSV and only evaluate the rest.
+    fsync (bool): Flush the output CSV to disk with fsync once all rows are written.
     """
+    if concurrency < 1:
+        raise ValueError("concurrency must be 1 or greater.")
+    if max_retries < 0:
+        raise ValueError("max_retries must be 0 or greater.")
+
     # 1. Initialize the OpenAI client
     print(f"Initializing OpenAI client with model 'gpt-4o'...")
     if not base_url:
         base_url = "https://api.openai.com/v1"  # Default to official OpenAI endpoint
 
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    # The SDK's own retries are off so that the retry loop below is the only retry policy
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
     print(f"Using API Base URL: {base_url}")
 
     # 2. Read the evaluation prompt template
@@ -50,64 +69,76 @@ def evaluate_responses(input_csv, prompt_file, output_csv, api_key, base_url):
         print(f"Error: Input CSV file not found at '{input_csv}'")
         return
 
-    # 4. Prepare the output CSV file
-    new_fieldnames = original_fieldnames + ['evaluation_score', 'evaluation_reasoning']
-    with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=new_fieldnames)
-        writer.writeheader()
-
-        # 5. Process each row, evaluate, and write to the new file
-        for row in tqdm(original_data, desc="Evaluating Responses", unit="row"):
-            original_prompt = row.get('input_text', '')
-            model_response = row.get('response', '')
-
-            if not model_response or model_response.startswith("ERROR:"):
-                # Skip rows with no response or with processing errors
-                eval_score = "skipped"
-                eval_reasoning = "Original response was empty or an error."
-            else:
-                # Construct the full prompt for the evaluator model
-                full_eval_prompt = eval_prompt_template.format(
-                    original_prompt=original_prompt,
-                    model_response=model_response
-                )
-
+    # 4. Define the per-row evaluation; the semaphore caps the number of concurrent requests
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def evaluate_row(row):
+        original_prompt = row.get('input_text', '')
+        model_response = row.get('response', '')
+
+        if not model_response or model_response.startswith("ERROR:"):
+            # Skip rows with no response or with processing errors
+            eval_score = "skipped"
+            eval_reasoning = "Original response was empty or an error."
+        else:
+            # Construct the full prompt for the evaluator model
+            full_eval_prompt = eval_prompt_template.format(
+                original_prompt=original_prompt,
+                model_response=model_response
+            )
+
+            async with semaphore:
                 try:
-                    response_text = ""
-                    for attempt in range(3):
+                    for attempt in range(max_retries + 1):
                         try:
-                            chat_completion = client.chat.completions.create(
+                            # Structured outputs constrain the reply to EvalSchema, so it arrives already parsed
+                            chat_completion = await client.beta.chat.completions.parse(
                                 model="gpt-4o",
                                 messages=[{"role": "user", "content": full_eval_prompt}],
-                                response_format={"type": "json_object"},
+                                response_format=EvalSchema,
                                 temperature=0.0,  # Low temperature for consistent evaluation
                                 timeout=120
                             )
-                            response_text = chat_completion.choices[0].message.content
+                            message = chat_completion.choices[0].message
                             break  # Success
-                        except Exception as e:
-                            if attempt < 2:
-                                time.sleep((attempt + 1) * 3)
+                        except RETRYABLE_ERRORS as e:
+                            if attempt < max_retries:
+                                await asyncio.sleep(retry_delay(attempt, e))
                             else:
                                 raise
 
-                    # Parse the JSON response from the evaluator
-                    eval_result = json.loads(response_text)
-                    eval_score = eval_result.get('score', 'parse_error')
-                    eval_reasoning = eval_result.get('reasoning', 'parse_error')
+                    if message.parsed is None:
+                        raise ValueError(f"Evaluator refused to answer: {message.refusal}")
+                    eval_score = message.parsed.score
+                    eval_reasoning = message.parsed.reasoning
 
                 except Exception as e:
                     print(f"\nAn error occurred while evaluating row {row.get('id', 'N/A')}: {e}")
                     eval_score = "error"
                     eval_reasoning = str(e)
 
-            # Add evaluation results to the row and write to the new CSV
-            row['evaluation_score'] = eval_score
-            row['evaluation_reasoning'] = eval_reasoning
-            writer.writerow(row)
+        # Append the evaluation results to the original columns
+        return [row.get(field) for field in original_fieldnames] + [eval_score, eval_reasoning]
 
-            # Rate limiting to be kind to the API
-            time.sleep(1)
+    # 5. Prepare the output CSV file
+    new_fieldnames = original_fieldnames + ['evaluation_score', 'evaluation_reasoning']
+    # A previous evaluation only counts as done if its row still matches the input CSV,
+    # so regenerated responses are evaluated again
+    csvfile, writer, done_ids = open_output_csv(
+        output_csv, new_fieldnames, lambda row: row.get('evaluation_score') != 'error',
+        expected_rows={int(row['id']): row for row in original_data}, resume=resume)
+    with csvfile:
+        # 6. Evaluate the remaining rows concurrently and write finished rows in batches
+        tasks = [evaluate_row(row) for row in original_data if int(row['id']) not in done_ids]
+        rows = []
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Evaluating Responses", unit="row"):
+            rows.append(await future)
+            if len(rows) >= WRITE_BATCH_SIZE:
+                writer.writerows(rows)
+                rows.clear()
+        writer.writerows(rows)
+        if fsync:
+            sync_to_disk(csvfile)
 
     print(f"\nEvaluation complete. Results saved to {output_csv}")
 
@@ -120,13 +151,29 @@ if __name__ == "__main__":
     parser.add_argument("--output-csv", required=True, help="Path for the output CSV file to save evaluation results.")
     parser.add_argument("--api-key", required=True, help="Your OpenAI API key.")
     parser.add_argument("--base-url", default=None, help="Optional: The base URL for the OpenAI API endpoint.")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Maximum number of evaluation requests in flight at the same time.")
+    parser.add_argument("--max-retries", type=int, default=2,
+                        help="Retries after the first failed attempt before a row is recorded as an error.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Start over instead of keeping the finished rows of an existing output CSV.")
+    parser.add_argument("--fsync", action="store_true",
+                        help="Flush the output CSV to disk with fsync once all rows are written.")
 
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be 1 or greater.")
+    if args.max_retries < 0:
+        parser.error("--max-retries must be 0 or greater.")
 
-    evaluate_responses(
+    asyncio.run(evaluate_responses(
         args.input_csv,
         args.prompt_file,
         args.output_csv,
         args.api_key,
-        args.base_url
-    )
\ No newline at end of file
+        args.base_url,
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        resume=not args.no_resume,
+        fsync=args.fsync
+    ))
\ No newline at end of file
@@ -1,12 +1,254 @@
-import json
-import csv
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
 import torch
 import argparse
 from tqdm import tqdm
 
+from utils import get_prompt, iter_json_items, open_output_csv, sync_to_disk
 
-def save_responses_to_csv(json_path, custom_string, model_path, output_csv, method=None):
+# Optional import for the vLLM backend
+try:
+    from vllm import LLM, SamplingParams
+except ImportError:
+    LLM = None
+
+
+def make_length_batches(lengths, batch_size):
+    """
+    Groups item positions into batches of similar token length.
+
+    Sorting by length means each batch draws from a single length bin and only spills into
+    the neighbouring bin when its own bin runs out, which keeps padding and the decode steps
+    spent on already-finished sequences to a minimum.
+
+    Args:
+    lengths (list[int]): Token length of each item.
+    batch_size (int): Maximum number of items per batch.
+
+    Returns:
+    list[list[int]]: Batches of positions into `lengths`.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def get_quantization_config(quant, compute_dtype):
+    """
+    Builds the bitsandbytes config for the requested weight quantization.
+
+    Args:
+    quant (str): One of 'none', 'int8', 'int4' or 'awq'.
+    compute_dtype (torch.dtype): The dtype 4-bit weights are dequantized to for matmuls.
+
+    Returns:
+    BitsAndBytesConfig or None: None for 'none' and for 'awq', whose checkpoints carry their own config.
+    """
+    if quant == 'int8':
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if quant == 'int4':
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=compute_dtype
+        )
+    return None
+
+
+def is_awq_checkpoint(model_path):
+    """
+    Returns True if the model's config declares AWQ-quantized weights.
+
+    Loading a checkpoint without one with 'awq' would silently give full-precision weights.
+    """
+    quantization_config = getattr(AutoConfig.from_pretrained(model_path, trust_remote_code=True),
+                                  'quantization_config', None)
+    if isinstance(quantization_config, dict):
+        return quantization_config.get('quant_method') == 'awq'
+    return getattr(quantization_config, 'quant_method', None) == 'awq'
+
+
+def generate_with_hf(model_path, records, batch_size, prefix=None, compile_model=False, pad_multiple=64,
+                     quant='none', draft_model_path=None):
+    """
+    Generates responses with Hugging Face transformers, batching prompts of similar length.
+
+    Args:
+    model_path (str): Path to the local Hugging Face model.
+    records (list[tuple[int, str]]): (id index, input text) pairs to generate responses for.
+    batch_size (int): Number of prompts passed to each model.generate call.
+    prefix (str, optional): Text every input starts with. If given, it is prefilled once and its
+        KV cache is reused by every batch instead of being recomputed per prompt.
+    compile_model (bool): Use a static KV cache and torch.compile the forward pass so decode steps
+        replay a captured CUDA graph instead of launching each kernel separately.
+    pad_multiple (int): With compile_model, inputs are padded to a multiple of this many tokens so
+        batches reuse a small set of compiled shapes.
+    quant (str): Weight quantization: 'none', 'int8' or 'int4' (bitsandbytes), or 'awq' for a
+        pre-quantized AWQ checkpoint.
+    draft_model_path (str, optional): Path to a small draft model sharing the tokenizer. If given, it
+        proposes tokens that the main model verifies in one forward pass (assisted generation), which
+        keeps greedy outputs identical while taking fewer sequential decode steps.
+
+    Yields:
+    list[tuple[int, str, str, int]]: (id index, input text, response, response length) for each finished batch.
+    """
+    # 1. Load the tokenizer and start encoding every prompt on a background thread, so the fast (Rust)
+    #    tokenizer works through the whole dataset while the model weights are loading
+    print(f"Loading model from: {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True, trust_remote_code=True)
+    # Batched generation needs left padding so every prompt ends right where its generated tokens begin
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if prefix:
+            # Only the per-item suffix is encoded; the prefix comes from the KV cache
+            encoding = executor.submit(
+                tokenizer, [input_text[len(prefix):] for _, input_text in records], add_special_tokens=False)
+        else:
+            encoding = executor.submit(tokenizer, [input_text for _, input_text in records])
+
+        # 2. Load the model
+        # AWQ kernels compute in float16
+        torch_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() and quant != 'awq' else torch.float16
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            device_map="auto",
+            torch_dtype=torch_dtype,
+            quantization_config=get_quantization_config(quant, torch_dtype),
+            trust_remote_code=True
+        ).eval()
+        print(f"Model weights use {model.get_memory_footprint() / 1024 ** 3:.2f} GiB (quantization: {quant}).")
+        draft_model = None
+        if draft_model_path:
+            print(f"Loading draft model from: {draft_model_path}")
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_path,
+                device_map="auto",
+                torch_dtype=torch_dtype,
+                trust_remote_code=True
+            ).eval()
+        all_input_ids = encoding.result()['input_ids']
+
+    # Assisted generation in transformers only supports one sequence per generate call
+    generation_kwargs = {}
+    if draft_model is not None:
+        generation_kwargs = {'assistant_model': draft_model, 'num_assistant_tokens': 5}
+        if batch_size != 1:
+            print("Speculative decoding generates one prompt at a time; using batch size 1.")
+            batch_size = 1
+
+    if compile_model:
+        model.generation_config.cache_implementation = "static"
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+        # Warm up once so graph capture happens before the first real batch
+        print("Compiling model...")
+        dummy_inputs = tokenizer(["Hello"], return_tensors="pt").to(model.device)
+        model.generate(**dummy_inputs, max_new_tokens=8, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+    print("Model loaded successfully.")
+
+    # Prefill the shared prefix once; each batch starts from a copy of this cache
+    prefix_ids = prefix_cache = None
+    if prefix:
+        prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(model.device)
+        prefix_cache = DynamicCache()
+        with torch.no_grad():
+            model(input_ids=prefix_ids, past_key_values=prefix_cache, use_cache=True)
+
+    # 3. Bucket prompts by token length so each batch holds prompts of similar size,
+    #    then generate responses one batch at a time
+    for positions in make_length_batches([len(ids) for ids in all_input_ids], batch_size):
+        batch = [records[position] for position in positions]
+
+        try:
+            # Pad the pre-encoded prompts of this batch into tensors
+            encoded = tokenizer.pad(
+                {'input_ids': [all_input_ids[position] for position in positions]},
+                padding=True,
+                pad_to_multiple_of=pad_multiple if compile_model else None,
+                return_tensors="pt"
+            ).to(model.device)
+
+            # Generate the model responses for the whole batch
+            if prefix_cache is not None:
+                # The left padding sits between prefix and suffix and is masked out,
+                # so the cached prefix positions stay valid for every row
+                batch_prefix_ids = prefix_ids.expand(len(batch), -1)
+                past_key_values = copy.deepcopy(prefix_cache)
+                past_key_values.batch_repeat_interleave(len(batch))
+                inputs = {
+                    'input_ids': torch.cat([batch_prefix_ids, encoded['input_ids']], dim=1),
+                    'attention_mask': torch.cat([torch.ones_like(batch_prefix_ids), encoded['attention_mask']], dim=1),
+                    'past_key_values': past_key_values
+                }
+            else:
+                inputs = encoded
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=4096,  # Increased limit for longer responses
+                do_sample=False,
+                temperature=1.0,
+                pad_token_id=tokenizer.pad_token_id,
+                **generation_kwargs
+            )
+
+            # Decode only the generated tokens (everything after the padded input) in one call,
+            # so the prompt is never decoded again
+            generated_ids = outputs[:, inputs['input_ids'].shape[1]:]
+            generated_responses = [response.strip() for response in
+                                   tokenizer.batch_decode(generated_ids, skip_special_tokens=True)]
+            results = [(response, len(response)) for response in generated_responses]
+        except Exception as e:
+            results = [(f"ERROR: {str(e)}", 0)] * len(batch)
+            print(f"\nAn error occurred while processing items {[idx + 1 for idx, _ in batch]}: {e}")
+
+        yield [(idx, input_text, response, length) for (idx, input_text), (response, length) in zip(batch, results)]
+
+
+def generate_with_vllm(model_path, records, quant='none'):
+    """
+    Generates responses with vLLM, which schedules all prompts itself (continuous batching, paged KV cache,
+    automatic prefix caching of the shared prompt prefix).
+
+    Args:
+    model_path (str): Path to the local Hugging Face model.
+    records (list[tuple[int, str]]): (id index, input text) pairs to generate responses for.
+    quant (str): 'none', or 'awq' for a pre-quantized AWQ checkpoint.
+
+    Yields:
+    list[tuple[int, str, str, int]]: (id index, input text, response, response length) for all records.
+    """
+    if not LLM:
+        raise ImportError("The 'vllm' library is required for the vLLM backend. Please install it with 'pip install vllm'.")
+
+    print(f"Loading model with vLLM from: {model_path}")
+    # AWQ only supports float16 activations. The quantization method is left for vLLM to read from the
+    # checkpoint, which lets it pick the faster awq_marlin kernel where the GPU supports it.
+    llm = LLM(
+        model=model_path,
+        dtype="bfloat16" if torch.cuda.is_bf16_supported() and quant != 'awq' else "float16",
+        max_model_len=8192,
+        gpu_memory_utilization=0.9,
+        enable_prefix_caching=True,
+        trust_remote_code=True
+    )
+    print("Model loaded successfully.")
+
+    # vLLM returns outputs in the same order as the submitted prompts
+    outputs = llm.generate(
+        [input_text for _, input_text in records],
+        SamplingParams(max_tokens=4096, temperature=0.0)
+    )
+    results = []
+    for (idx, input_text), output in zip(records, outputs):
+        generated_response = output.outputs[0].text.strip()
+        results.append((idx, input_text, generated_response, len(generated_response)))
+    yield results
+
+
+def save_responses_to_csv(json_path, custom_string, model_path, output_csv, method=None, batch_size=8, backend='hf',
+                          prefix_cache=False, compile_model=False, quant='none', resume=True, fsync=False,
+                          draft_model_path=None):
     """
     Processes JSON data, gets model responses, and saves them to a CSV file.
 
@@ -16,75 +258,81 @@ def save_responses_to_csv(json_path, custom_string, model_path, output_csv, meth
     model_path (str): Path to the local Hugging Face model.
     output_csv (str): Path for the output CSV file.
     method (str, optional): The method to determine which prompt format to use. Defaults to None.
+    batch_size (int): Number of prompts passed to each model.generate call (hf backend only). Defaults to 8.
+    backend (str): Generation backend, 'hf' (transformers) or 'vllm'. Defaults to 'hf'.
+    prefix_cache (bool): Prefill the shared "User: {custom_string} " prefix once and reuse its KV cache
+        (hf backend only; vLLM always caches prefixes). Defaults to False.
+    compile_model (bool): Use a static KV cache and torch.compile for CUDA-graph decoding
+        (hf backend only; cannot be combined with prefix_cache). Defaults to False.
+    quant (str): Weight quantization, 'none', 'int8', 'int4' or 'awq' (the vllm backend supports
+        'none' and 'awq'). Defaults to 'none'.
+    resume (bool): Keep the successful rows of an existing output CSV and only generate the rest.
+        Defaults to True.
+    fsync (bool): Flush the output CSV to disk with fsync once all rows are written. Defaults to False.
+    draft_model_path (str, optional): Path to a draft model for speculative decoding (hf backend only;
+        cannot be combined with prefix_cache or compile_model). Defaults to None.
     """
-    # 1. Load the model and tokenizer
-    print(f"Loading model from: {model_path}")
-    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(
-        model_path,
-        device_map="auto",
-        torch_dtype=torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16,
-        trust_remote_code=True
-    ).eval()
-    print("Model loaded successfully.")
+    if prefix_cache and compile_model:
+        raise ValueError("prefix_cache and compile_model cannot be combined: the static cache cannot start from a prefilled prefix.")
 
-    # 2. Read the JSON data
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    total_items = len(data['data'])
-    print(f"Processing started, found {total_items} records in {json_path}")
-
-    # 3. Prepare the CSV file for writing
-    with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['id', 'input_text', 'response', 'response_length']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        # 4. Process each item with a tqdm progress bar
-        for idx, item in enumerate(tqdm(data, desc="Generating Responses", unit="item")):
-            prompt = ""
-            if method == 'nja':
-                # Extract the 'nja_format' field for the 'nja' method
-                prompt = item.get('nja_format', '')
-                if not prompt:
-                    # If nja_format is empty, skip this item
-                    continue
-            else:
-                # For any other method (including 'None'), use the 'prompt' field
-                prompt = item.get('prompt', '')
-
-            # Construct the final input text for the model
-            # This format is suitable for many instruction-tuned models.
-            input_text = f"User: {custom_string} {prompt}\nAssistant:"
-
-            try:
-                # Generate the model response
-                inputs = tokenizer(input_text, return_tensors="pt").to(model.device)
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=4096,  # Increased limit for longer responses
-                    do_sample=False,
-                    temperature=1.0,
-                    pad_token_id=tokenizer.eos_token_id
-                )
-                full_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-                # Extract only the generated part of the response (stripping the input)
-                generated_response = full_response[len(input_text):].strip()
-                response_length = len(generated_response)
-            except Exception as e:
-                generated_response = f"ERROR: {str(e)}"
-                response_length = 0
-                print(f"\nAn error occurred while processing item {idx + 1}: {e}")
-
-            # Write the results to the CSV row
-            writer.writerow({
-                'id': idx + 1,
-                'input_text': input_text,
-                'response': generated_response,
-                'response_length': response_length
-            })
+    if backend == 'vllm' and quant not in ('none', 'awq'):
+        raise ValueError(f"Quantization '{quant}' is only supported by the hf backend.")
+
+    if draft_model_path and (backend == 'vllm' or prefix_cache or compile_model):
+        raise ValueError("draft_model_path is only supported by the hf backend without prefix_cache or compile_model.")
+
+    if quant == 'awq' and not is_awq_checkpoint(model_path):
+        raise ValueError(f"Quantization 'awq' needs an AWQ checkpoint; '{model_path}' has no AWQ quantization_config.")
+
+    # 1. Stream the JSON records and build the model inputs, skipping items without a usable prompt.
+    #    This format is suitable for many instruction-tuned models; its shared prefix is built once
+    #    and is also what the prefix cache prefills.
+    prefix = f"User: {custom_string} "
+    suffix = "\nAssistant:"
+    records = []
+    for idx, item in enumerate(iter_json_items(json_path)):
+        # 'nja' uses the 'nja_format' field, any other method (including 'None') the 'prompt' field
+        prompt = get_prompt(item, method)
+        if method == 'nja' and not prompt:
+            # If nja_format is empty, skip this item
+            continue
+
+        # Construct the final input text for the model
+        input_text = prefix + prompt + suffix
+        records.append((idx, input_text))
+    print(f"Processing started, found {len(records)} prompts in {json_path}")
+
+    # 2. Prepare the CSV file for writing, carrying over the rows a previous run completed
+    fieldnames = ['id', 'input_text', 'response', 'response_length']
+    csvfile, writer, done_ids = open_output_csv(
+        output_csv, fieldnames, lambda row: not row.get('response', '').startswith("ERROR:"),
+        expected_rows={idx + 1: {'input_text': input_text} for idx, input_text in records}, resume=resume)
+    records = [(idx, input_text) for idx, input_text in records if idx + 1 not in done_ids]
+    if not records:
+        # Nothing left to generate, so do not load the model at all
+        with csvfile:
+            if fsync:
+                sync_to_disk(csvfile)
+        print(f"All prompts already have responses in {output_csv}")
+        return
+
+    # 3. Select the generation backend
+    if backend == 'vllm':
+        result_batches = generate_with_vllm(model_path, records, quant=quant)
+    else:
+        result_batches = generate_with_hf(model_path, records, batch_size, prefix=prefix if prefix_cache else None,
+                                          compile_model=compile_model, quant=quant,
+                                          draft_model_path=draft_model_path)
+
+    # 4. Write each finished batch with a tqdm progress bar
+    #    (rows are written in batch order; the 'id' column keeps the original position)
+    with csvfile, tqdm(total=len(records), desc="Generating Responses", unit="item") as pbar:
+        for results in result_batches:
+            writer.writerows((idx + 1, input_text, generated_response, response_length)
+                             for idx, input_text, generated_response, response_length in results)
+            pbar.update(len(results))
+        if fsync:
+            sync_to_disk(csvfile)
 
 
 if __name__ == "__main__":
@@ -96,8 +344,27 @@ if __name__ == "__main__":
     parser.add_argument("--output_csv", type=str, required=True, help="Path for the output CSV file.")
     parser.add_argument("--method", type=str, required=True,
                         help="The processing method to use (e.g., 'nja' or 'None').")
+    parser.add_argument("--batch_size", type=int, default=8,
+                        help="Number of prompts generated together in one batch.")
+    parser.add_argument("--backend", type=str, choices=['hf', 'vllm'], default='hf',
+                        help="Generation backend: 'hf' (transformers generate) or 'vllm'.")
+    parser.add_argument("--prefix_cache", action="store_true",
+                        help="Prefill the shared prompt prefix once and reuse its KV cache (hf backend only).")
+    parser.add_argument("--compile", action="store_true",
+                        help="Use a static KV cache and torch.compile for CUDA-graph decoding (hf backend only).")
+    parser.add_argument("--quant", type=str, choices=['none', 'int8', 'int4', 'awq'], default='none',
+                        help="Weight quantization: bitsandbytes int8/int4, or 'awq' for an AWQ checkpoint.")
+    parser.add_argument("--no_resume", action="store_true",
+                        help="Start over instead of keeping the successful rows of an existing output CSV.")
+    parser.add_argument("--fsync", action="store_true",
+                        help="Flush the output CSV to disk with fsync once all rows are written.")
+    parser.add_argument("--draft_model_path", type=str, default=None,
+                        help="Optional: path to a small draft model (same tokenizer) for speculative decoding.")
 
     args = parser.parse_args()
 
     # Call the main function with the parsed arguments
-    save_responses_to_csv(args.json_path, args.custom_string, args.model_path, args.output_csv, args.method)
\ No newline at end of file
+    save_responses_to_csv(args.json_path, args.custom_string, args.model_path, args.output_csv, args.method,
+                          batch_size=args.batch_size, backend=args.backend,
+                          prefix_cache=args.prefix_cache, compile_model=args.compile, quant=args.quant,
+                          resume=not args.no_resume, fsync=args.fsync, draft_model_path=args.draft_model_path)
\ No newline at end of file
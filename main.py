@@ -1,14 +1,24 @@
 import sys
-import subprocess
+import asyncio
+import functools
 import json
 import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from get_api_response import get_api_responses, create_api_client, create_http_client
+from utils import load_json
+
+# One pooled HTTP client (and one event loop, see run_all) serves every API run in this process,
+# so keep-alive connections are reused across models and methods.
+HTTP_CLIENT = create_http_client()
+_api_clients = {}
 
 
 def load_config(config_path='config.json'):
     """Loads a JSON configuration file from the specified path."""
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return load_json(config_path)
     except FileNotFoundError:
         print(f"Error: Configuration file '{config_path}' not found.")
         sys.exit(1)
@@ -17,15 +27,33 @@ def load_config(config_path='config.json'):
         sys.exit(1)
 
 
-def run_model_script(model_key, model_info, method, dataset_config):
+def get_api_client(model_key, model_info):
+    """Returns the cached API client for a model, creating it on first use."""
+    if model_key not in _api_clients:
+        _api_clients[model_key] = create_api_client(
+            model_info['name'],
+            model_info['api_key'],
+            model_info.get('base_url'),
+            http_client=HTTP_CLIENT
+        )
+    return _api_clients[model_key]
+
+
+async def run_model_script(model_key, model_info, method, dataset_config, gpu_executor=None, resume=True):
     """
-    Dynamically builds and calls the appropriate script based on model type.
+    Runs the appropriate response script based on model type.
+
+    API models run in-process on the shared HTTP client. Local models run get_hf_response.py in a
+    subprocess, so the model's GPU memory is released when the job exits.
 
     Args:
     model_key (str): The key for the model in the config (e.g., 'GLM4', 'GPT').
     model_info (dict): The configuration dictionary for the model.
     method (str): The processing method ('None' or 'nja').
     dataset_config (dict): The configuration dictionary for the dataset.
+    gpu_executor (ThreadPoolExecutor, optional): Executor that waits for local-model subprocesses off the event loop.
+        Runs them inline (blocking the loop) if not given.
+    resume (bool): Keep the completed rows of an existing output CSV and only process the rest.
     """
     # Get path and name from the dataset configuration
     json_path = dataset_config['path']
@@ -42,54 +70,81 @@ def run_model_script(model_key, model_info, method, dataset_config):
     else:
         custom_string = ""
 
-    # --- Dynamically build the command based on model type ---
-    base_command = ["python"]
-
     # Check if it's an open-source model (has a 'path')
     if 'path' in model_info:
-        script_name = "get_hf_response.py"  # Script for local/HuggingFace models
-        command = base_command + [
-            script_name,
+        print(f"Running: Model={model_key}, Method={method}, Dataset={dataset_name}...")
+        command = [
+            sys.executable, "get_hf_response.py",
             "--model_path", model_info['path'],
-            # The following argument is for get_hf_response.py if it needs the model key
-            # "--model_name_for_output", model_key
+            "--json_path", json_path,
+            "--custom_string", custom_string,
+            "--output_csv", output_csv,
+            "--method", method,
+            "--backend", model_info.get('backend', 'hf')
         ]
+        if not resume:
+            command.append("--no_resume")
+        job = functools.partial(subprocess.run, command, check=True)
+        if gpu_executor:
+            await asyncio.get_running_loop().run_in_executor(gpu_executor, job)
+        else:
+            job()
 
     # Check if it's a closed-source model (has an 'api_key')
     elif 'api_key' in model_info:
-        script_name = "get_api_response.py"  # Script for API-based models
-        command = base_command + [
-            script_name,
-            "--model_name", model_info['name'],
-            "--api_key", model_info['api_key']
-        ]
-        # *** MODIFICATION START ***
-        # Check for base_url and add it to the command if it exists
-        base_url = model_info.get('base_url')
-        if base_url:
-            command.extend(["--base_url", base_url])
-        # *** MODIFICATION END ***
+        print(f"Running: Model={model_key}, Method={method}, Dataset={dataset_name}...")
+        await get_api_responses(
+            model_info['name'],
+            model_info['api_key'],
+            model_info.get('base_url'),
+            json_path,
+            custom_string,
+            output_csv,
+            method,
+            client=get_api_client(model_key, model_info),
+            resume=resume
+        )
 
     else:
         print(f"Warning: Model '{model_key}' has an unknown configuration. Skipping.")
         return
 
-    # Add common arguments for all scripts
-    command.extend([
-        "--json_path", json_path,
-        "--custom_string", custom_string,
-        "--output_csv", output_csv,
-        "--method", method
-    ])
-
-    # Execute the script
-    print(f"Running: Model={model_key}, Method={method}, Dataset={dataset_name}...")
-    # For debugging, you can uncomment the next line to see the exact command being run
-    # print(f"Executing command: {' '.join(command)}")
-    subprocess.run(command)
     print(f"Finished running. Output saved to {output_csv}")
 
 
+async def run_all(models, methods, all_models, dataset_config, resume=True):
+    """
+    Runs every requested model/method combination on a single event loop.
+
+    API jobs are network-bound and run concurrently with each other. Local models share the GPU,
+    so their subprocesses run one at a time from a single worker thread, overlapping with the API jobs.
+    With resume, each job keeps the completed rows of its existing output CSV.
+    """
+    jobs = []
+    for model_key in models:
+        if model_key not in all_models:
+            print(f"Warning: Model key '{model_key}' is not defined in config.json. Skipping.")
+            continue
+
+        for method_to_run in methods:
+            jobs.append((model_key, method_to_run))
+
+    async def run_job(model_key, method, gpu_executor):
+        try:
+            await run_model_script(model_key, all_models[model_key], method, dataset_config, gpu_executor,
+                                   resume=resume)
+            return model_key, method, None
+        except Exception as e:
+            return model_key, method, e
+
+    with ThreadPoolExecutor(max_workers=1) as gpu_executor:
+        tasks = [run_job(model_key, method, gpu_executor) for model_key, method in jobs]
+        for future in asyncio.as_completed(tasks):
+            model_key, method, error = await future
+            if error:
+                print(f"Error: Model={model_key}, Method={method} failed: {error}")
+
+
 if __name__ == "__main__":
     # 1. Set up the command-line argument parser
     parser = argparse.ArgumentParser(description="Run model scripts based on a configuration file.")
@@ -110,6 +165,11 @@ if __name__ == "__main__":
         default=["None", "nja"],
         help="A list of methods to use (e.g., None nja). Defaults to 'None' and 'nja'."
     )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Start every job over instead of keeping the completed rows of existing output CSVs."
+    )
     args = parser.parse_args()
 
     # 2. Load the configuration
@@ -124,15 +184,7 @@ if __name__ == "__main__":
         sys.exit(1)
     dataset_config = config['datasets'][args.dataset]
 
-    # 5. Iterate through the specified models and methods and execute the script
-    for model_key in args.models:
-        if model_key not in all_models:
-            print(f"Warning: Model key '{model_key}' is not defined in config.json. Skipping.")
-            continue
-
-        model_info = all_models[model_key]
-
-        for method_to_run in args.methods:
-            run_model_script(model_key, model_info, method_to_run, dataset_config)
+    # 5. Iterate through the specified models and methods and run each one
+    asyncio.run(run_all(args.models, args.methods, all_models, dataset_config, resume=not args.no_resume))
 
     print("\nAll specified scripts have been executed successfully.")
\ No newline at end of file
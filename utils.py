@@ -0,0 +1,208 @@
+import csv
+import json
+import os
+import random
+
+# Optional imports for faster JSON parsing
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional imports for the API error types the retry helpers inspect
+try:
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+except ImportError:
+    RateLimitError = None
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+# Errors worth retrying: throttling, timeouts, dropped connections and server-side failures.
+# Anything else (authentication, malformed requests, context length) fails on the first attempt.
+RETRYABLE_ERRORS = ()
+if RateLimitError:
+    RETRYABLE_ERRORS += (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+if google_exceptions:
+    RETRYABLE_ERRORS += (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+                         google_exceptions.DeadlineExceeded)
+
+# Output rows are buffered and written this many at a time
+WRITE_BATCH_SIZE = 100
+# User-space write buffer for output CSV files (1 MiB)
+CSV_BUFFER_SIZE = 1 << 20
+
+
+def load_json(json_path):
+    """
+    Loads a whole JSON file, using the orjson C parser when it is installed and json otherwise.
+
+    Both raise a json.JSONDecodeError (orjson's error is a subclass) on invalid input.
+    """
+    if orjson:
+        with open(json_path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(json_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def iter_json_items(json_path, prefix=None):
+    """
+    Yields the records of a JSON dataset one at a time.
+
+    With ijson installed the records are parsed lazily, so processing can start before the whole
+    file has been read; otherwise the file is loaded with load_json and the same records are yielded.
+
+    Args:
+    json_path (str): Path to the input JSON file.
+    prefix (str, optional): ijson path of the records: 'item' for a top-level list, 'data.item' for
+        {"data": [...]}. Detected from the file's first character if not given.
+    """
+    if prefix is None:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            first_char = f.read(1)
+            while first_char.isspace():
+                first_char = f.read(1)
+        prefix = 'data.item' if first_char == '{' else 'item'
+
+    if ijson:
+        with open(json_path, 'rb') as f:
+            yield from ijson.items(f, prefix)
+        return
+
+    data = load_json(json_path)
+    for key in prefix.split('.')[:-1]:
+        data = data[key]
+    yield from data
+
+
+def get_prompt(item, method):
+    """
+    Returns the prompt of a dataset record for the given method, or '' if it has none.
+
+    Records are either dicts with 'prompt' and 'nja_format' fields, or plain strings, which are
+    treated as the 'prompt' field.
+
+    Args:
+    item (dict or str): One dataset record.
+    method (str): 'nja' selects the 'nja_format' field; any other method selects 'prompt'.
+    """
+    if isinstance(item, str):
+        return '' if method == 'nja' else item
+    return item.get('nja_format', '') if method == 'nja' else item.get('prompt', '')
+
+
+def open_output_csv(output_csv, fieldnames, is_complete, expected_rows=None, resume=True):
+    """
+    Opens an output CSV for appending rows, writing its header first when the file is new or lacks it.
+
+    With resume, the rows of an existing file that `is_complete` accepts are kept, so an
+    interrupted run only redoes the missing and failed items. When `expected_rows` is given, a row is
+    also only kept if it still matches the current inputs, so rows left over from a run on a changed
+    dataset or prompt are redone rather than silently reused. If any other rows are present they
+    are dropped, so that their retried versions do not end up as duplicates: the kept rows are
+    written to a temporary file that is fsynced and then atomically replaces the output, so a crash
+    at any point leaves either the old file or the new one on disk.
+
+    Args:
+    output_csv (str): Path for the output CSV file.
+    fieldnames (list[str]): Column names, in order.
+    is_complete (callable): Takes a row dict of the existing file and returns True to keep it.
+    expected_rows (dict, optional): Maps each int id of the current inputs to the column values its row
+        must have, e.g. {1: {'input_text': ...}}. Rows whose id is missing or whose values differ are dropped.
+    resume (bool): Keep completed rows of an existing file instead of starting over.
+
+    Returns:
+    tuple: (open file object, csv.writer, set of the int ids already completed)
+    """
+    existing_fieldnames = None
+    truncated = False
+    if resume and os.path.exists(output_csv):
+        with open(output_csv, 'r', newline='', encoding='utf-8') as f:
+            # Strict parsing raises on a quoted field left open at the end of the file
+            reader = csv.DictReader(f, strict=True)
+            existing_fieldnames = reader.fieldnames
+            rows = []
+            try:
+                rows.extend(reader)
+            except csv.Error:
+                truncated = True
+
+    # Start over without resume, without an existing file, or when the file does not begin with our
+    # header (e.g. a crash left it empty because the header was still in the write buffer)
+    if existing_fieldnames != fieldnames:
+        csvfile = open(output_csv, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE)
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        return csvfile, writer, set()
+
+    # A write cut short by a crash can end anywhere in the last row, even inside its last column,
+    # so a last row without its line terminator is never kept
+    with open(output_csv, 'rb') as f:
+        f.seek(max(os.path.getsize(output_csv) - 1, 0))
+        if f.read() != b'\n' and not truncated:
+            truncated = True
+            rows = rows[:-1]
+
+    def is_kept(row):
+        if None in row.values() or not is_complete(row):
+            return False
+        if expected_rows is None:
+            return True
+        expected = expected_rows.get(int(row['id']))
+        return expected is not None and all(row.get(field) == value for field, value in expected.items())
+
+    completed_rows = [row for row in rows if is_kept(row)]
+    print(f"Resuming: keeping {len(completed_rows)} completed rows from {output_csv}")
+
+    if truncated or len(completed_rows) < len(rows):
+        tmp_csv = output_csv + '.tmp'
+        with open(tmp_csv, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as f:
+            writer = csv.writer(f)
+            writer.writerow(fieldnames)
+            writer.writerows([row.get(field) for field in fieldnames] for row in completed_rows)
+            sync_to_disk(f)
+        os.replace(tmp_csv, output_csv)
+
+    csvfile = open(output_csv, 'a', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE)
+    return csvfile, csv.writer(csvfile), {int(row['id']) for row in completed_rows}
+
+
+def sync_to_disk(csvfile):
+    """
+    Flushes an output file and fsyncs it, so finished results survive a crash of the machine.
+
+    Writes are otherwise left to the 1 MiB user-space buffer and the OS page cache; call this
+    once at the end of a run rather than per row.
+    """
+    csvfile.flush()
+    os.fsync(csvfile.fileno())
+
+
+def retry_delay(attempt, error=None, base=1.0, cap=30.0):
+    """
+    Returns how many seconds to wait before retrying a failed API call.
+
+    A rate-limit error's Retry-After header is honored when present (up to `cap`); otherwise the delay
+    is exponential backoff with jitter, so concurrent requests do not all retry at the same moment.
+
+    Args:
+    attempt (int): Zero-based number of the attempt that just failed.
+    error (Exception, optional): The exception raised by that attempt.
+    base (float): Delay of the first retry, in seconds.
+    cap (float): Upper bound for the delay, in seconds.
+    """
+    if RateLimitError and isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        try:
+            return min(float(retry_after), cap)
+        except (TypeError, ValueError):
+            pass  # Missing, or given as an HTTP date; fall back to backoff
+    return min(base * 2 ** attempt + random.uniform(0, base), cap)